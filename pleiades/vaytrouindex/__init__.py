@@ -1,9 +1,10 @@
-from Products.CMFCore import utils 
-
-from Products.Archetypes import atapi
-from Products.ATContentTypes import permission
-
 def initialize(context):
+    # Archetypes and the criterion module are imported here rather than at
+    # module level so that importing the package (scripts, tests, the
+    # index module itself) stays cheap. Zope still imports them at startup.
+    from Products.CMFCore import utils
+    from Products.Archetypes import atapi
+    from Products.ATContentTypes import permission
     from pleiades.vaytrouindex import criteria
     criteria # import to register
 
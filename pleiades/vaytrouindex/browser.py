@@ -1,5 +1,7 @@
 
 from pleiades.vaytrouindex.index import VaytrouIndex, LocationQueryIndex
+from simplejson import dumps
+import re
 
 
 class VaytrouIndexAddView:
@@ -52,3 +54,26 @@ class LocationQueryIndexAddView:
         # form, which submits to this method to add a catalog index.
         return self.index()
 
+
+class SpatialJoinView:
+    """Report the polygon documents containing many documents as JSON
+
+    ``ids`` and the optional ``containers`` are document ids separated by
+    commas or whitespace.
+    """
+
+    def _ids(self, value):
+        return [int(v) for v in re.split(r'[\s,]+', value or '') if v]
+
+    def __call__(self, ids='', containers=''):
+        response = self.request.response
+        try:
+            targets = self._ids(ids)
+            containerIds = self._ids(containers) or None
+        except ValueError:
+            response.setStatus(400)
+            return "ids and containers must be integer document ids"
+        result = self.context.spatialJoin(targets, containerIds)
+        response.setHeader('Content-Type', 'application/json')
+        return dumps(dict(
+            (str(rid), found) for rid, found in zip(targets, result)))
@@ -0,0 +1,237 @@
+"""Per-process caching of Vaytrou query results
+
+Every ZEO client keeps its own cache of query responses. Cached entries are
+invalidated through a changelog that is stored persistently on the index:
+each transaction that changes the index adds the bounds of the changed
+documents under a (generation, token) key. Concurrent writers may share a
+generation, so a client replays every entry of recent generations that it
+has not yet seen and evicts only the cached queries whose bounds touch the
+changed documents.
+
+Within a single published Zope request, lookups are also memoized on the
+request itself, so repeated queries and entry lookups reach neither the
+process cache nor the server more than once. The memo never outlives the
+request or its transaction. Responses are stored as tuples and callers get
+copies, so nothing handed out can change a stored response.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from zope.annotation.interfaces import IAnnotations
+import time
+import transaction
+
+
+# A changelog entry that invalidates every cached query
+FLUSH = None
+
+
+def query_bounds(range, geom):
+    """Return the (minx, miny, maxx, maxy) that bounds a query's results
+
+    Returns None for queries, such as nearest neighbor, whose results can
+    be changed by a document anywhere.
+    """
+    if range in ('intersection', 'within'):
+        try:
+            coords = tuple(map(float, geom))
+        except (TypeError, ValueError):
+            return None
+        if len(coords) == 2:
+            return coords + coords
+        if len(coords) == 4:
+            return coords
+    return None
+
+
+def query_key(range, geom):
+    """Return a hashable, normalized key for a query"""
+    def freeze(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v) for v in value)
+        if isinstance(value, (int, long, float)):
+            return float(value)
+        return value
+    return (range, freeze(geom))
+
+
+def _intersects(a, b):
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+
+class QueryCache(object):
+    """A bounded cache of query responses for one Vaytrou server
+
+    The cache holds at most ``max_items`` response items in all, and does
+    not keep responses of more than ``max_result_items`` items.
+    """
+
+    # Entries this many generations behind the latest one seen are still
+    # checked, since a concurrent writer may have committed them late
+    slack = 100
+
+    def __init__(self, max_items=20000, max_result_items=2000):
+        self.max_items = max_items
+        self.max_result_items = max_result_items
+        self.generation = None
+        # When entries were last evicted for a change, and how many times
+        self.evicted = 0.0
+        self.evictions = 0
+        self._items = 0
+        self._seen = set()
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, bounds, result, evictions=None):
+        """Cache a response
+
+        ``evictions`` is the value of the ``evictions`` attribute read
+        before the response was requested. If anything has been evicted
+        since, the response may predate that change and is not kept.
+        """
+        result = tuple(result)
+        if len(result) > self.max_result_items:
+            return
+        self._lock.acquire()
+        try:
+            if evictions is not None and evictions != self.evictions:
+                return
+            self._remove(key)
+            self._entries[key] = (bounds, result)
+            self._items += len(result)
+            while self._items > self.max_items:
+                self._remove(next(iter(self._entries)))
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._items -= len(entry[1])
+
+    def _clear(self):
+        self._entries.clear()
+        self._items = 0
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self.evictions += 1
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def evict(self, changes):
+        """Evict cached queries affected by a sequence of changed bounds"""
+        self._lock.acquire()
+        try:
+            self._evict(changes)
+        finally:
+            self._lock.release()
+
+    def _evict(self, changes):
+        self.evicted = time.time()
+        self.evictions += 1
+        if FLUSH in changes:
+            self._clear()
+            return
+        for key, (bounds, result) in list(self._entries.items()):
+            if bounds is None:
+                self._remove(key)
+                continue
+            for changed in changes:
+                if _intersects(bounds, changed):
+                    self._remove(key)
+                    break
+
+    def sync(self, changelog, latest):
+        """Replay changelog entries this cache has not yet seen
+
+        ``changelog`` is an OOBTree mapping (generation, token) keys to
+        sequences of changed bounds, or None if the index has none.
+        ``latest`` is the current value of the index's generation counter,
+        which counts the entries ever published.
+        """
+        self._lock.acquire()
+        try:
+            seen = self.generation
+            if seen is not None and latest <= seen:
+                # Nothing new, or this connection's view is older than one
+                # that has already been replayed
+                return
+            if seen is None:
+                # A new cache holds nothing that could be stale
+                if changelog:
+                    low = (latest - self.slack + 1,)
+                    self._seen = set(changelog.keys(min=low))
+            else:
+                low = (seen - self.slack + 1,)
+                found = 0
+                if changelog:
+                    for key, changes in changelog.items(min=low):
+                        if key not in self._seen:
+                            self._evict(changes)
+                            self._seen.add(key)
+                            found += 1
+                if found < latest - seen:
+                    # Some new entries are not in the window: they were
+                    # pruned, or written by a transaction whose view of
+                    # the generation was older than the window
+                    self.evicted = time.time()
+                    self.evictions += 1
+                    self._clear()
+            self.generation = latest
+            horizon = latest - self.slack
+            self._seen = set(k for k in self._seen if k[0] > horizon)
+        finally:
+            self._lock.release()
+
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def get_query_cache(vaytrou_uri):
+    """Return the process-wide query cache for a Vaytrou server"""
+    _caches_lock.acquire()
+    try:
+        cache = _caches.get(vaytrou_uri)
+        if cache is None:
+            cache = _caches[vaytrou_uri] = QueryCache()
+        return cache
+    finally:
+        _caches_lock.release()
+
+
+MEMO_KEY = 'pleiades.vaytrouindex.memo'
+
+
+def request_memo(context):
+    """Return a mapping for memoizing lookups in the current request
+
+    Returns None outside of a published request, such as in scripts that
+    use a single fake request for a whole run, or if the request cannot be
+    annotated. The mapping is emptied when a new transaction begins.
+    """
+    request = getattr(context, 'REQUEST', None)
+    if request is None or request.get('PUBLISHED') is None:
+        return None
+    try:
+        annotations = IAnnotations(request)
+    except TypeError:
+        return None
+    current = transaction.get()
+    entry = annotations.get(MEMO_KEY)
+    if entry is None or entry[0] is not current:
+        entry = annotations[MEMO_KEY] = (current, {})
+    return entry[1]
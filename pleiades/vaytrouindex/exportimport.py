@@ -1,9 +1,106 @@
 
+from Acquisition import aq_inner, aq_parent
+from cStringIO import StringIO
+from gzip import GzipFile
 from pleiades.vaytrouindex.interfaces import IVaytrouIndex
+from Products.CMFCore.utils import getToolByName
 from Products.GenericSetup.interfaces import ISetupEnviron
 from Products.GenericSetup.utils import NodeAdapterBase
 from Products.GenericSetup.utils import PropertyManagerHelpers
+from simplejson import dumps, loads
 from zope.component import adapts
+import logging
+
+log = logging.getLogger('pleiades.vaytrou')
+
+# Indexed features are exported as line-delimited GeoJSON, split into files
+# of at most CHUNK_SIZE features so that neither export nor import holds
+# more than one chunk in memory.
+CHUNK_SIZE = 5000
+SUBDIR = 'vaytrou'
+
+
+def chunk_name(index_id, number, compress):
+    name = '%s-%04d.jsonl' % (index_id, number)
+    if compress:
+        name += '.gz'
+    return name
+
+
+def encode_chunk(features, compress):
+    """Return features as line-delimited GeoJSON, optionally gzipped"""
+    buf = StringIO()
+    if compress:
+        out = GzipFile(fileobj=buf, mode='wb')
+    else:
+        out = buf
+    for feature in features:
+        out.write(dumps(feature))
+        out.write('\n')
+    if compress:
+        out.close()
+    return buf.getvalue()
+
+
+def decode_chunk(data, compress):
+    """Yield the features of a chunk written by encode_chunk"""
+    if compress:
+        lines = GzipFile(fileobj=StringIO(data), mode='rb')
+    else:
+        lines = StringIO(data)
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield loads(line)
+
+
+def iter_chunks(features, size=CHUNK_SIZE):
+    """Group an iterable of features into lists of at most size items"""
+    chunk = []
+    for feature in features:
+        chunk.append(feature)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def feature_remapper(index):
+    """Return a function that re-keys features to this catalog's ids
+
+    The function takes an iterable of features from another site and
+    yields them with ids of this index's catalog. Features are matched to
+    catalog records by their ``path`` property, which is relative to the
+    portal, and skipped if the path is not in the catalog. Raises
+    ValueError if the index is not in a catalog, since the exported ids
+    belong to another catalog.
+    """
+    catalog = aq_parent(aq_inner(index))
+    uids = getattr(catalog, 'uids', None)
+    if uids is None:
+        raise ValueError(
+            "Can't import features into %s outside of a catalog"
+            % index.getId())
+    portal = getToolByName(index, 'portal_url').getPortalObject()
+    root = '/'.join(portal.getPhysicalPath())
+    return lambda features: _remap(uids, root, features)
+
+
+def _remap(uids, root, features):
+    skipped = 0
+    for feature in features:
+        path = (feature.get('properties') or {}).get('path')
+        rid = None
+        if path:
+            rid = uids.get('%s/%s' % (root, path.strip('/')))
+        if rid is None:
+            skipped += 1
+            continue
+        feature['id'] = str(rid)
+        yield feature
+    if skipped:
+        log.warn("Skipped %d features not found in the catalog", skipped)
 
 
 class VaytrouIndexNodeAdapter(NodeAdapterBase, PropertyManagerHelpers):
@@ -18,6 +115,8 @@ class VaytrouIndexNodeAdapter(NodeAdapterBase, PropertyManagerHelpers):
         """
         node = self._getObjectNode('index')
         node.appendChild(self._extractProperties())
+        if self.context.export_contents:
+            self._exportContents(node)
         return node
 
     def _importNode(self, node):
@@ -27,12 +126,59 @@ class VaytrouIndexNodeAdapter(NodeAdapterBase, PropertyManagerHelpers):
             self._purgeProperties()
         self._initProperties(node)
 
+        remap = None
+        if node.hasAttribute('contents'):
+            # Fail before clearing if the contents can't be imported
+            remap = feature_remapper(self.context)
+
         if node.hasAttribute('clear'):
             # Clear the index
             self.context.clear()
 
+        if remap is not None:
+            self._importContents(node, remap)
+
     node = property(_exportNode, _importNode)
 
+    def _exportContents(self, node):
+        """Write indexed features to data files, one chunk at a time.
+        """
+        index_id = self.context.getId()
+        compress = bool(self.context.export_compress)
+        content_type = compress and 'application/x-gzip' or 'application/json'
+        count = 0
+        number = 0
+        for number, chunk in enumerate(
+                iter_chunks(self.context.iterFeatures()), 1):
+            self.environ.writeDataFile(
+                chunk_name(index_id, number, compress),
+                encode_chunk(chunk, compress), content_type, SUBDIR)
+            count += len(chunk)
+        node.setAttribute('contents', SUBDIR)
+        node.setAttribute('compress', str(compress))
+        # Chunks left in the directory by an earlier, larger export are
+        # not part of this one
+        node.setAttribute('chunks', str(number))
+        log.info("Exported %d features of %s", count, index_id)
+
+    def _importContents(self, node, remap):
+        """Load indexed features from the data files written on export.
+        """
+        index_id = self.context.getId()
+        subdir = node.getAttribute('contents')
+        compress = node.getAttribute('compress') == 'True'
+        count = 0
+        for number in range(1, int(node.getAttribute('chunks') or 0) + 1):
+            name = chunk_name(index_id, number, compress)
+            data = self.environ.readDataFile(name, subdir)
+            if data is None:
+                log.warn("Missing data file %s/%s for %s",
+                         subdir, name, index_id)
+                continue
+            count += self.context.loadFeatures(
+                remap(decode_chunk(data, compress)))
+        log.info("Imported %d features into %s", count, index_id)
+
 
 class PlaceVaytrouIndexNodeAdapter(NodeAdapterBase, PropertyManagerHelpers):
 
@@ -1,25 +1,145 @@
 """Pluggable Vaytrou-based spatial indexes"""
 
 from BTrees.IIBTree import IIBTree, IISet, union, intersection
-from httplib2 import Http
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
 from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
+from pleiades.vaytrouindex.cache import FLUSH
+from pleiades.vaytrouindex.cache import get_query_cache
+from pleiades.vaytrouindex.cache import query_bounds
+from pleiades.vaytrouindex.cache import query_key
+from pleiades.vaytrouindex.cache import request_memo
 from pleiades.vaytrouindex.interfaces import IVaytrouConnectionManager
 from pleiades.vaytrouindex.interfaces import IVaytrouIndex
-from Products.CMFCore.utils import _getAuthenticatedUser, getToolByName
 from Products.PluginIndexes.common.util import parseIndexRequest
 from Products.PluginIndexes.interfaces import IPluggableIndex
 from simplejson import dumps, loads
+from threading import Lock
 from transaction.interfaces import IDataManager
 from urllib import urlencode
 from zope.interface import implements
 import logging
 import os
+import random
+import time
 import transaction
 
 log = logging.getLogger('pleiades.vaytrou')
 
 
+def _http():
+    # httplib2 is imported on the first request rather than when ZCML
+    # loads this module
+    from httplib2 import Http
+    return Http(timeout=1000)
+
+
+def _iter_positions(coords):
+    # Flatten GeoJSON coordinates of any nesting depth to (x, y) pairs
+    if not coords:
+        return
+    if isinstance(coords[0], (int, long, float)):
+        yield float(coords[0]), float(coords[1])
+    else:
+        for c in coords:
+            for p in _iter_positions(c):
+                yield p
+
+
+def _iter_geometry_positions(geom):
+    if geom is None:
+        return
+    if geom.get('type') == 'GeometryCollection':
+        for g in geom.get('geometries', ()):
+            for p in _iter_geometry_positions(g):
+                yield p
+    else:
+        for p in _iter_positions(geom.get('coordinates')):
+            yield p
+
+
+def feature_bounds(feature):
+    """Return the (minx, miny, maxx, maxy) bounds of a GeoJSON-like feature
+
+    An explicit ``bbox`` member is preferred, otherwise bounds are computed
+    from the geometry's coordinates. Returns None if the feature has no
+    coordinates.
+    """
+    bbox = feature.get('bbox')
+    if bbox and len(bbox) >= 4:
+        # A bbox of n dimensions lists n minima, then n maxima
+        n = len(bbox) // 2
+        return tuple(map(float, list(bbox[:2]) + list(bbox[n:n + 2])))
+    minx = miny = maxx = maxy = None
+    for x, y in _iter_geometry_positions(feature.get('geometry')):
+        if minx is None:
+            minx = maxx = x
+            miny = maxy = y
+        else:
+            minx = min(minx, x)
+            miny = min(miny, y)
+            maxx = max(maxx, x)
+            maxy = max(maxy, y)
+    if minx is None:
+        return None
+    return (minx, miny, maxx, maxy)
+
+
+def feature_point(feature, bounds=None):
+    """Return a representative (x, y) point of a GeoJSON-like feature
+
+    The point itself for Point geometries, otherwise the center of the
+    feature's bounds.
+    """
+    geom = feature.get('geometry') or {}
+    if geom.get('type') == 'Point':
+        coords = geom.get('coordinates')
+        if coords and len(coords) >= 2:
+            return (float(coords[0]), float(coords[1]))
+    if bounds is None:
+        bounds = feature_bounds(feature)
+    if bounds is None:
+        return None
+    return ((bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0)
+
+
+def _in_ring(x, y, ring):
+    # Even-odd ray casting
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) \
+                and x < (xj - xi) * (y - yi) / float(yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def point_in_geometry(point, geom):
+    """Return True if a Polygon or MultiPolygon geometry contains point
+
+    Geometries of other types contain no points.
+    """
+    if not geom:
+        return False
+    if geom.get('type') == 'Polygon':
+        polygons = [geom.get('coordinates') or []]
+    elif geom.get('type') == 'MultiPolygon':
+        polygons = geom.get('coordinates') or []
+    else:
+        return False
+    x, y = point
+    for rings in polygons:
+        if rings and _in_ring(x, y, rings[0]) \
+                and not any(_in_ring(x, y, hole) for hole in rings[1:]):
+            return True
+    return False
+
+
 class VaytrouIndex(PropertyManager, SimpleItem):
     # Inspired by and derived from alm.solrindex's SolrIndex
 
@@ -34,22 +154,57 @@ class VaytrouIndex(PropertyManager, SimpleItem):
             'description':
             'The name of an environment variable that will provide '
             'the Vaytrou URI.  Ignored if vaytrou_uri_static is non-empty.'},
+        {'id': 'vaytrou_read_uris', 'type': 'lines', 'mode': 'w',
+         'description':
+         'URIs of Vaytrou replicas to send queries to, one per line. '
+         'Queries go to the primary Vaytrou URI if empty.'},
+        {'id': 'vaytrou_write_fanout', 'type': 'boolean', 'mode': 'w',
+         'description':
+         'Send index changes to the read replicas as well as the primary'},
         {'id': 'response_page_size', 'type': 'int', 'mode': 'w',
-         'description': 'Number of items in a response page'}
+         'description': 'Number of items in a response page'},
+        {'id': 'max_response_page_size', 'type': 'int', 'mode': 'w',
+         'description':
+         'If greater than response_page_size, response pages grow up to '
+         'this many items for queries with many hits'},
+        {'id': 'export_contents', 'type': 'boolean', 'mode': 'w',
+         'description':
+         'Export indexed features along with the properties of the index'},
+        {'id': 'export_compress', 'type': 'boolean', 'mode': 'w',
+         'description': 'Gzip exported features'},
         )
 
     manage_options = PropertyManager.manage_options + SimpleItem.manage_options
 
     _v_temp_cm = None
+    _bounds = None
+    _points = None
+    _summaries_complete = False
+    _changes = None
+    _generation = None
+    changelog_size = 1000
+    max_pending_changes = 1000
     vaytrou_uri_static = ''
     vaytrou_uri_env_var = ''
+    vaytrou_read_uris = ()
+    vaytrou_write_fanout = False
+    replica_lag = 10.0
     response_page_size = 0
+    max_response_page_size = 0
+    export_contents = False
+    export_compress = True
+    import_batch_size = 500
     query_options = ['query', 'range']
+    world = (-180.0, -90.0, 180.0, 90.0)
 
     def __init__(self, id, vaytrou_uri_static='', response_page_size=0):
         self.id = id
         self.vaytrou_uri_static = vaytrou_uri_static
         self.response_page_size = response_page_size
+        self._bounds = IOBTree()
+        self._points = IOBTree()
+        self._summaries_complete = True
+        self.createChangelog()
 
     @property
     def vaytrou_uri(self):
@@ -78,7 +233,13 @@ class VaytrouIndex(PropertyManager, SimpleItem):
             manager = fc.get(oid)
             if manager is None \
                     or manager.vaytrou_uri != self.vaytrou_uri \
-                    or manager.response_page_size != self.response_page_size:
+                    or manager.vaytrou_read_uris != \
+                        tuple(self.vaytrou_read_uris) \
+                    or manager.vaytrou_write_fanout != \
+                        bool(self.vaytrou_write_fanout) \
+                    or manager.response_page_size != self.response_page_size \
+                    or manager.max_response_page_size != \
+                        self.max_response_page_size:
                 manager = IVaytrouConnectionManager(self)
                 fc[oid] = manager
 
@@ -89,16 +250,289 @@ class VaytrouIndex(PropertyManager, SimpleItem):
         """
         return [self.getId()]
 
+    @property
+    def _query_cache(self):
+        """The process-wide query cache, synchronized with the changelog"""
+        cache = get_query_cache(self.vaytrou_uri)
+        if self._generation is None:
+            cache.sync(None, 0)
+        else:
+            cache.sync(self._changes, self._generation())
+        return cache
+
+    def createChangelog(self):
+        """Create the changelog through which ZEO clients share changes
+
+        Called when the index is created, and by the 0.2 upgrade for older
+        indexes.
+        """
+        if self._changes is None:
+            self._changes = OOBTree()
+            self._generation = Length()
+
+    def _record_change(self, *bounds):
+        # The server has already been changed, so evict from this
+        # process's cache right away. The bounds are also published to the
+        # changelog just before commit, and evicted again when the
+        # transaction finishes in case another thread cached them since.
+        if not bounds:
+            return
+        get_query_cache(self.vaytrou_uri).evict(bounds)
+        memo = request_memo(self)
+        if memo:
+            memo.clear()
+        cm = self.connection_manager
+        pending = cm.pending_changes
+        if not pending:
+            transaction.get().addBeforeCommitHook(
+                self._publish_changes, (cm,))
+        if FLUSH in bounds \
+                or len(pending) + len(bounds) > self.max_pending_changes:
+            # Too many to be worth tracking one by one
+            pending[:] = [FLUSH]
+        elif pending != [FLUSH]:
+            pending.extend(bounds)
+        cm.set_changed()
+
+    def _publish_changes(self, cm):
+        # Entries are keyed by (generation, random token). The generation
+        # counter is a Length, which resolves concurrent increments, and
+        # the token keeps keys of concurrent writers that read the same
+        # generation distinct, so ZEO clients committing at the same time
+        # don't conflict.
+        changes = tuple(cm.pending_changes)
+        if not changes:
+            return
+        if FLUSH in changes:
+            changes = (FLUSH,)
+        if self._changes is None:
+            # Only for indexes that skipped the upgrade step; this one
+            # write to the index object may conflict
+            self.createChangelog()
+        changelog = self._changes
+        generation = self._generation() + 1
+        self._generation.change(1)
+        changelog[(generation, '%016x' % random.getrandbits(64))] = changes
+        # Prune now and then rather than on every commit, so that
+        # concurrent writers seldom delete the same keys
+        if random.random() < 1.0 / 50:
+            horizon = (generation - self.changelog_size,)
+            for key in list(changelog.keys(max=horizon)):
+                del changelog[key]
+
+    def _changed_bounds(self, documentId, bounds=None):
+        # The bounds a change to documentId may affect: where it was, and
+        # where it is now. Where it was is unknown for documents indexed
+        # before bounds were stored, unless the summaries were backfilled.
+        old = None
+        if self._bounds is not None:
+            old = self._bounds.get(documentId)
+        if old is None and not self._summaries_complete:
+            return (FLUSH,)
+        return tuple(b for b in (old, bounds) if b is not None)
+
+    def _store_summary(self, documentId, feature):
+        # Keep the bounds and representative point of a document locally
+        # so that result listings need not ask the server for them
+        if self._bounds is None:
+            self._bounds = IOBTree()
+            self._points = IOBTree()
+        bounds = feature_bounds(feature)
+        point = feature_point(feature, bounds)
+        if bounds is None:
+            self._drop_summary(documentId)
+            return
+        if self._bounds.get(documentId) != bounds:
+            self._bounds[documentId] = bounds
+        if self._points.get(documentId) != point:
+            self._points[documentId] = point
+
+    def _drop_summary(self, documentId):
+        if self._bounds is None:
+            return
+        if documentId in self._bounds:
+            del self._bounds[documentId]
+        if documentId in self._points:
+            del self._points[documentId]
+
+    def updateSummaries(self):
+        """Rebuild the stored bounds and points from the Vaytrou server
+
+        Needed once for indexes populated before bounds and points were
+        stored. Returns the number of documents summarized.
+        """
+        bounds = IOBTree()
+        points = IOBTree()
+        count = 0
+        for feature in self.iterFeatures():
+            b = feature_bounds(feature)
+            if b is None:
+                continue
+            documentId = int(feature['id'])
+            bounds[documentId] = b
+            points[documentId] = feature_point(feature, b)
+            count += 1
+        self._bounds = bounds
+        self._points = points
+        self._summaries_complete = True
+        log.info("Summarized %d documents of %s", count, self.getId())
+        return count
+
+    def _read_connection(self, cm):
+        # Replicas may not have this transaction's changes yet, nor the
+        # latest changes this process has been told of. Read from the
+        # primary until they have had time to catch up, so that stale
+        # results aren't cached after the eviction.
+        connection = cm.connection
+        primary = getattr(connection, 'primary', None)
+        if primary is not None and (
+                cm.pending_changes
+                or time.time() - get_query_cache(self.vaytrou_uri).evicted
+                < self.replica_lag):
+            return primary
+        return connection
+
+    def getBoundsForObject(self, documentId, default=None):
+        """Return the locally stored (minx, miny, maxx, maxy) of documentId"""
+        if self._bounds is None:
+            return default
+        return self._bounds.get(documentId, default)
+
+    def getPointForObject(self, documentId, default=None):
+        """Return the locally stored representative (x, y) of documentId"""
+        if self._points is None:
+            return default
+        return self._points.get(documentId, default)
+
+    def getSummariesForObjects(self, documentIds):
+        """Return a mapping of document ids to geometry summaries
+
+        Each summary is a mapping with ``bbox`` and ``point`` items read
+        from local storage. Ids without stored geometry are omitted. No
+        request is made to the Vaytrou server.
+        """
+        result = {}
+        if self._bounds is None:
+            return result
+        bounds = self._bounds
+        points = self._points
+        for rid in documentIds:
+            bbox = bounds.get(rid)
+            if bbox is not None:
+                result[rid] = dict(bbox=bbox, point=points.get(rid))
+        return result
+
+    def spatialJoin(self, targets, containerIds=None, cell_size=1.0):
+        """Find, for many targets at once, the documents that contain them
+
+        ``targets`` is a sequence of document ids, (x, y) points, or
+        GeoJSON-like geometry mappings. Ids and geometries are located by
+        their representative point. ``containerIds`` restricts the
+        candidate containers, which are otherwise all indexed documents.
+        Returns a list, in the order of ``targets``, of sorted lists of the
+        ids of Polygon and MultiPolygon documents that contain each target.
+        Targets that can't be located get an empty list.
+
+        Candidates are found from the stored bounds using a grid of
+        ``cell_size`` buckets. The geometry of each candidate is then
+        fetched from the server once and tested exactly. Candidates whose
+        geometry can't be fetched are logged and dropped.
+        """
+        points = [self._target_point(t) for t in targets]
+        if self._bounds is None:
+            return [[] for p in points]
+        bounds = self._bounds
+        if containerIds is None:
+            candidates = bounds.items()
+        else:
+            candidates = ((rid, bounds.get(rid)) for rid in containerIds)
+
+        # Bucket containers by grid cell. Containers spanning many cells are
+        # checked against every point instead.
+        grid = {}
+        large = []
+        for rid, b in candidates:
+            if b is None or b[0] == b[2] or b[1] == b[3]:
+                # Points and axis-aligned lines contain nothing
+                continue
+            i0, j0 = int(b[0] // cell_size), int(b[1] // cell_size)
+            i1, j1 = int(b[2] // cell_size), int(b[3] // cell_size)
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > 256:
+                large.append((rid, b))
+                continue
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    grid.setdefault((i, j), []).append((rid, b))
+
+        # Filter by bounds first
+        matches = []
+        for target, point in zip(targets, points):
+            found = set()
+            if point is not None:
+                x, y = point
+                cell = grid.get(
+                    (int(x // cell_size), int(y // cell_size)), ())
+                for cid, b in list(cell) + large:
+                    if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                        found.add(cid)
+                if isinstance(target, (int, long)):
+                    found.discard(target)
+            matches.append(found)
+
+        # Then by geometry, fetching each candidate's geometry once
+        primary = getattr(
+            self.connection_manager.connection, 'primary',
+            self.connection_manager.connection)
+        geometries = {}
+        for cid in set().union(*matches):
+            try:
+                items = primary.items(cid)['items']
+            except (VaytrouConnectionError, VaytrouHTTPError) as e:
+                log.warn("Dropped join candidate %s: %s", cid, str(e))
+                items = None
+            geometries[cid] = items and items[0].get('geometry') or None
+        result = []
+        for point, found in zip(points, matches):
+            result.append(sorted(
+                cid for cid in found
+                if point_in_geometry(point, geometries[cid])))
+        return result
+
+    def _target_point(self, target):
+        if isinstance(target, (int, long)):
+            return self.getPointForObject(target)
+        if isinstance(target, dict):
+            return feature_point(dict(geometry=target))
+        if len(target) >= 2:
+            return (float(target[0]), float(target[1]))
+        return None
+
     def getEntryForObject(self, documentId, default=None):
-        """Return the information stored for documentId"""
+        """Return the information stored for documentId
+
+        The geometry is only kept by the Vaytrou server, so this makes a
+        request; use getSummariesForObjects when bounds suffice. If the
+        server can't be reached, the locally stored bounds are returned
+        without geometry.
+        """
+        memo = request_memo(self)
+        key = ('items', self.vaytrou_uri, documentId)
+        if memo is not None and key in memo:
+            return [dict(e) for e in memo[key]]
         cm = self.connection_manager
         try:
-            response = cm.connection.items(documentId)
-            return [dict(
+            response = self._read_connection(cm).items(documentId)
+            entry = tuple(dict(
                 geometry=item.get('geometry'), bbox=item.get('bbox')
-                ) for item in response['items']]
+                ) for item in response['items'])
         except (VaytrouConnectionError, VaytrouHTTPError):
-            return None
+            bounds = self.getBoundsForObject(documentId)
+            if bounds is None:
+                return None
+            return [dict(geometry=None, bbox=list(bounds))]
+        if memo is not None:
+            memo[key] = entry
+        return [dict(e) for e in entry]
 
     def index_object(self, documentId, obj, threshold=None):
         """Index the object using a Vaytrou client connection
@@ -127,22 +561,70 @@ class VaytrouIndex(PropertyManager, SimpleItem):
         except Exception as e:
             log.warn("Failed to index_doc %s: %s", documentId, str(e))
             return 0
+        self._record_change(
+            *self._changed_bounds(documentId, feature_bounds(o)))
+        self._store_summary(documentId, o)
         return 1
 
     def unindex_object(self, documentId):
         """Remove the documentId from the index."""
         log.debug("Unindexing %d", documentId)
         cm = self.connection_manager
+        # Read from the primary, which a replica may lag behind
+        primary = getattr(cm.connection, 'primary', cm.connection)
         try:
-            item = cm.connection.items(documentId)['items'][0]
+            item = primary.items(documentId)['items'][0]
             doc = dict(unindex=[item])
             cm.connection.batch(doc)
             log.debug("Passed unindex_doc %s", documentId)
         except Exception as e:
             log.warn("Failed to unindex_doc %s: %s", documentId, str(e))
             return 0
+        self._record_change(*self._changed_bounds(documentId))
+        self._drop_summary(documentId)
         return 1
 
+    def iterFeatures(self):
+        """Yield every feature stored by the Vaytrou server
+
+        Features are fetched a response page at a time, from the primary
+        server rather than a replica that may lag behind it.
+        """
+        cm = self.connection_manager
+        primary = getattr(cm.connection, 'primary', cm.connection)
+        return primary.iter_query('intersection', self.world)
+
+    def loadFeatures(self, features, batch_size=None):
+        """Index an iterable of features, sending them to Vaytrou in batches
+
+        Each feature's ``id`` must be a document id of this index's catalog.
+        Returns the number of features indexed.
+        """
+        batch_size = batch_size or self.import_batch_size
+        cm = self.connection_manager
+        count = 0
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if len(batch) >= batch_size:
+                count += self._load_batch(cm, batch)
+                batch = []
+        if batch:
+            count += self._load_batch(cm, batch)
+        return count
+
+    def _load_batch(self, cm, batch):
+        cm.connection.batch(dict(index=batch))
+        changed = []
+        for feature in batch:
+            documentId = int(feature['id'])
+            changed.extend(
+                self._changed_bounds(documentId, feature_bounds(feature)))
+            self._store_summary(documentId, feature)
+        self._record_change(*changed)
+        log.debug("Loaded %d features", len(batch))
+        return len(batch)
+
     def _apply_index(self, request, cid='', raw=False):
         """Apply query specified by request, a mapping containing the query.
 
@@ -163,11 +645,29 @@ class VaytrouIndex(PropertyManager, SimpleItem):
         log.debug("querying: %r", params)
 
         cm = self.connection_manager
+        key = query_key(params['range'], params['query'])
+        memo = request_memo(self)
+        memo_key = ('query', self.vaytrou_uri, key)
         try:
-            response = cm.connection.query(
-                params['range'], params['query'])
+            if memo is not None and memo_key in memo:
+                response = memo[memo_key]
+            else:
+                cache = self._query_cache
+                response = cache.get(key)
+                if response is None:
+                    # A change evicted while the query is in flight may not
+                    # be reflected in its response, which is then not kept
+                    evictions = cache.evictions
+                    response = tuple(self._read_connection(cm).query(
+                        params['range'], params['query']))
+                    cache.set(
+                        key, query_bounds(params['range'], params['query']),
+                        response, evictions)
+                if memo is not None:
+                    memo[memo_key] = response
             if raw:
-                return response
+                # The stored response is shared, so callers get copies
+                return [dict(item) for item in response]
             result = IIBTree()
             for item in response:
                 score = int(float(item.get('score', 0)) * 1000)
@@ -177,6 +677,21 @@ class VaytrouIndex(PropertyManager, SimpleItem):
             log.warn("Failed to apply %s: %s", params, str(e))
             return None
 
+    def pageSizeReport(self):
+        """Return the fastest response page size observed for each range
+
+        Page sizes are ranked by total latency per query, separately for
+        each power of ten range of hit counts. Covers queries made by this
+        process to the primary Vaytrou server and its read replicas.
+        """
+        merged = PageStats()
+        uris = []
+        for uri in [self.vaytrou_uri] + list(self.vaytrou_read_uris):
+            if uri and uri not in uris:
+                uris.append(uri)
+                merged.update(get_page_stats(uri))
+        return merged.report()
+
     def numObjects(self):
         """Return number of unique words in the index"""
         return 0
@@ -195,9 +710,15 @@ class VaytrouIndex(PropertyManager, SimpleItem):
         cm = self.connection_manager
         try:
             response = cm.connection.clear()
-            return response
         except VaytrouHTTPError:
             return 0
+        # Only once the server is empty, or the summaries would no longer
+        # describe what it holds
+        if self._bounds is not None:
+            self._bounds.clear()
+            self._points.clear()
+        self._record_change(FLUSH)
+        return response
 
 
 class LocationQueryIndex(PropertyManager, SimpleItem):
@@ -244,7 +765,29 @@ class LocationQueryIndex(PropertyManager, SimpleItem):
         if record.keys is None:
             return None
 
+        from Products.CMFCore.utils import _getAuthenticatedUser
+        from Products.CMFCore.utils import getToolByName
         catalog = getToolByName(self, 'portal_catalog')
+        user = _getAuthenticatedUser(self)
+        allowed = catalog._listAllowedRolesAndUsers(user)
+
+        # Results are filtered by what the user may see, and the user can
+        # change within a request
+        memo = request_memo(self)
+        memo_key = ('location', self.getId(), self.geoindex_id,
+                    query_key(record.range, record.keys),
+                    tuple(sorted(allowed)))
+        if memo is not None and memo_key in memo:
+            result = memo[memo_key]
+        else:
+            result = self._locate(record, catalog, allowed)
+            if memo is not None:
+                memo[memo_key] = result
+        # The memoized set is shared, so callers get a copy
+        return IISet(result[0]), result[1]
+
+    def _locate(self, record, catalog, allowed):
+        from Products.CMFCore.utils import getToolByName
 
         geoIndex = catalog._catalog.getIndex(self.geoindex_id)
         geoRequest = {}
@@ -257,10 +800,8 @@ class LocationQueryIndex(PropertyManager, SimpleItem):
             paths[int(item['id'])] = item['properties']['path']
 
         rolesIndex = catalog._catalog.getIndex('allowedRolesAndUsers')
-        user = _getAuthenticatedUser(self)
         perms_set = rolesIndex._apply_index(
-            {'allowedRolesAndUsers': catalog._listAllowedRolesAndUsers(user)}
-            )[0]
+            {'allowedRolesAndUsers': allowed})[0]
 
         r = intersection(perms_set, IISet(paths.keys()))
 
@@ -323,14 +864,112 @@ class VaytrouHTTPError(Error):
         return str(self.resp)
 
 
+def hits_bucket(hits):
+    """Return the power of ten range, such as "100-999", of a hit count"""
+    low = 1
+    while low * 10 <= hits:
+        low *= 10
+    if low == 1:
+        return '0-9'
+    return '%d-%d' % (low, low * 10 - 1)
+
+
+class PageStats(object):
+    """Query latency by query type, hit count and page size
+
+    Kept for one Vaytrou server. Queries are compared by their total
+    latency within a bucket of similar hit counts, so that queries with
+    few hits don't skew the figures of queries with many.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = Lock()
+
+    def record(self, range, hits, page_size, seconds):
+        key = (range, hits_bucket(hits), page_size)
+        self._lock.acquire()
+        try:
+            stat = self._stats.setdefault(key, [0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return a copy of the recorded figures"""
+        self._lock.acquire()
+        try:
+            return dict((k, list(v)) for k, v in self._stats.items())
+        finally:
+            self._lock.release()
+
+    def update(self, other):
+        """Add the figures recorded by another PageStats"""
+        for key, (queries, seconds) in other.snapshot().items():
+            self._lock.acquire()
+            try:
+                stat = self._stats.setdefault(key, [0, 0.0])
+                stat[0] += queries
+                stat[1] += seconds
+            finally:
+                self._lock.release()
+
+    def report(self):
+        """Return the page size with the least latency per query
+
+        The result maps each query range to a mapping of hit count buckets
+        to mappings with ``page_size``, ``queries`` and
+        ``seconds_per_query`` items.
+        """
+        best = {}
+        for (range, bucket, page_size), (queries, seconds) in \
+                self.snapshot().items():
+            per_query = seconds / queries
+            buckets = best.setdefault(range, {})
+            current = buckets.get(bucket)
+            if current is None or per_query < current['seconds_per_query']:
+                buckets[bucket] = dict(
+                    page_size=page_size, queries=queries,
+                    seconds_per_query=per_query)
+        return best
+
+    def best_page_size(self, range, hits):
+        stat = self.report().get(range, {}).get(hits_bucket(hits))
+        return stat and stat['page_size'] or None
+
+
+_page_stats = {}
+_page_stats_lock = Lock()
+
+
+def get_page_stats(uri):
+    _page_stats_lock.acquire()
+    try:
+        stats = _page_stats.get(uri)
+        if stats is None:
+            stats = _page_stats[uri] = PageStats()
+        return stats
+    finally:
+        _page_stats_lock.release()
+
+
 class VaytrouConnection(object):
 
-    def __init__(self, uri, count=20):
+    # Pages that take longer than this are not grown further
+    page_seconds = 1.0
+
+    # How often to grow pages even when a best size is known, so that
+    # larger sizes keep being measured
+    explore = 0.1
+
+    def __init__(self, uri, count=20, max_count=0):
         self.uri = uri
         self.count = count
+        self.max_count = max_count
 
     def info(self):
-        h = Http(timeout=1000)
+        h = _http()
         try:
             resp, content = h.request(self.uri, "GET")
         except Exception as e:
@@ -340,7 +979,7 @@ class VaytrouConnection(object):
         return loads(content)
 
     def items(self, docId):
-        h = Http(timeout=1000)
+        h = _http()
         try:
             resp, content = h.request(
                 self.uri + '/items/%s' % str(docId), "GET")
@@ -351,6 +990,19 @@ class VaytrouConnection(object):
         return loads(content)
 
     def query(self, range, geom):
+        return list(self.iter_query(range, geom))
+
+    def iter_query(self, range, geom):
+        """Yield the items matching a query, one response page at a time
+
+        If ``max_count`` exceeds ``count``, the first page has ``count``
+        items. The rest use the page size that has served queries of this
+        range and number of hits fastest, or else double in size while
+        pages stay quick, never exceeding ``max_count``.
+        """
+        stats = get_page_stats(self.uri)
+        adaptive = self.max_count > self.count
+        best = None
         data = {'start': 0, 'count': self.count}
         if range in ('intersection', 'within'):
             bbox = ','.join(map(str, geom))
@@ -360,24 +1012,48 @@ class VaytrouConnection(object):
         elif range == 'nearest':
             bbox = ','.join(map(str, geom[0]))
             data.update(bbox=bbox, limit=geom[1])
-        h = Http(timeout=1000)
-        results = []
+        h = _http()
+        seen = 0
         N = 1
-        try:
-            while len(results) < N:
+        seconds = 0.0
+        page_size = data['count']
+        while seen < N:
+            page_size = max(page_size, data['count'])
+            page_started = time.time()
+            try:
                 resp, content = h.request(
                     self.uri + '/%s?%s' % (range, urlencode(data)),
                     "GET")
-                r = loads(content)
-                N = r['hits']
-                results += r['items']
-                data['start'] += r['count']
-        except:
-            raise
-        return results
+            except Exception as e:
+                raise VaytrouConnectionError(e)
+            if resp.status != 200:
+                raise VaytrouHTTPError(resp)
+            r = loads(content)
+            page_seconds = time.time() - page_started
+            seconds += page_seconds
+            N = r['hits']
+            for item in r['items']:
+                yield item
+            seen += len(r['items'])
+            data['start'] += r['count']
+            if not r['count']:
+                break
+            if not adaptive:
+                continue
+            if best is None:
+                best = stats.best_page_size(range, N) or 0
+                if best and random.random() < self.explore:
+                    best = 0
+                if best:
+                    data['count'] = min(best, self.max_count)
+                    continue
+            if not best and page_seconds < self.page_seconds:
+                data['count'] = min(
+                    self.max_count, max(data['count'], r['count']) * 2)
+        stats.record(range, N, page_size, seconds)
 
     def batch(self, doc):
-        h = Http(timeout=1000)
+        h = _http()
         try:
             resp, content = h.request(self.uri, "POST", body=dumps(doc))
         except Exception as e:
@@ -387,7 +1063,7 @@ class VaytrouConnection(object):
         return 1
 
     def clear(self):
-        h = Http(timeout=1000)
+        h = _http()
         doc = {'clear': True}
         try:
             resp, content = h.request(self.uri, "POST", body=dumps(doc))
@@ -401,6 +1077,260 @@ class VaytrouConnection(object):
     def commit(self):
         pass
 
+    def close(self):
+        pass
+
+    def delete_query(self):
+        pass
+
+
+def is_server_failure(error):
+    """Return True for errors another server may not have
+
+    That is, no response at all or a 5xx status.
+    """
+    if isinstance(error, VaytrouConnectionError):
+        return True
+    if isinstance(error, VaytrouHTTPError):
+        return getattr(error.resp, 'status', 0) >= 500
+    return False
+
+
+class ReplicaState(object):
+    """Load and health of one Vaytrou server, shared by all threads
+
+    Fanned out writes that a replica misses while it is down are kept, in
+    order, and replayed before it is used again. A replica that misses more
+    than ``max_missed`` writes can't be resynced this way and is left out
+    of the read pool until the process restarts.
+    """
+
+    retry_interval = 30.0
+    max_missed = 1000
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0
+        self.down_until = 0.0
+        self.missed = []
+        self.stale = False
+        self.resyncing = False
+
+    def mark_down(self):
+        self.down_until = time.time() + self.retry_interval
+        log.warn("Vaytrou replica %s is down", self.uri)
+
+    def mark_up(self):
+        if self.down_until:
+            log.info("Vaytrou replica %s is back up", self.uri)
+        self.down_until = 0.0
+
+    def miss(self, name, args):
+        """Keep a write for replay, or mark the replica stale"""
+        if self.stale:
+            return
+        if len(self.missed) >= self.max_missed:
+            self.stale = True
+            self.missed = []
+            log.error("Vaytrou replica %s missed more than %d writes and "
+                      "won't be read from until it is resynced and this "
+                      "process restarted", self.uri, self.max_missed)
+            return
+        self.missed.append((name, args))
+
+
+_replica_states = {}
+_replica_lock = Lock()
+
+
+def get_replica_state(uri):
+    _replica_lock.acquire()
+    try:
+        state = _replica_states.get(uri)
+        if state is None:
+            state = _replica_states[uri] = ReplicaState(uri)
+        return state
+    finally:
+        _replica_lock.release()
+
+
+class ReplicatedVaytrouConnection(object):
+    """Spreads reads over Vaytrou replicas and sends writes to the primary
+
+    Reads go to the healthy replica with the fewest outstanding requests,
+    and to the primary if no replica is healthy. A replica that fails to
+    respond is skipped for ``ReplicaState.retry_interval`` seconds, then
+    checked with an info request, and sent the fanned out writes it missed,
+    before it is used again. Writes go to the primary, and also to every
+    replica if ``fanout`` is true.
+    """
+
+    def __init__(self, uri, count=20, read_uris=(), fanout=False,
+                 connection_factory=VaytrouConnection, max_count=0):
+        self.uri = uri
+        self.count = count
+        self.fanout = fanout
+        self.primary = connection_factory(uri, count, max_count)
+        self.replicas = [
+            connection_factory(u, count, max_count) for u in read_uris]
+
+    def _healthy(self, replica):
+        state = get_replica_state(replica.uri)
+        _replica_lock.acquire()
+        try:
+            if state.stale:
+                return False
+            if not state.down_until:
+                return True
+            if time.time() < state.down_until or state.resyncing:
+                return False
+            # One thread at a time replays, so writes stay in order
+            state.resyncing = True
+        finally:
+            _replica_lock.release()
+        try:
+            try:
+                replica.info()
+                self._resync(replica, state)
+            except Error as e:
+                log.warn("Failed to resync replica %s: %s",
+                         replica.uri, str(e))
+                state.mark_down()
+                return False
+        finally:
+            state.resyncing = False
+        return not state.stale
+
+    def _resync(self, replica, state):
+        # Replay missed writes, oldest first, and mark the replica up only
+        # once none are left
+        while True:
+            _replica_lock.acquire()
+            try:
+                if state.stale:
+                    return
+                if not state.missed:
+                    state.mark_up()
+                    return
+                name, args = state.missed[0]
+            finally:
+                _replica_lock.release()
+            getattr(replica, name)(*args)
+            _replica_lock.acquire()
+            try:
+                if state.missed:
+                    del state.missed[0]
+            finally:
+                _replica_lock.release()
+
+    def _candidates(self):
+        # Healthy replicas, least loaded first, then the primary. Shuffled
+        # first so that equally loaded replicas share the reads.
+        replicas = [r for r in self.replicas if self._healthy(r)]
+        random.shuffle(replicas)
+        replicas.sort(key=lambda r: get_replica_state(r.uri).outstanding)
+        return replicas + [self.primary]
+
+    def _begin(self, replica):
+        state = get_replica_state(replica.uri)
+        _replica_lock.acquire()
+        try:
+            state.outstanding += 1
+        finally:
+            _replica_lock.release()
+        return state
+
+    def _end(self, state):
+        _replica_lock.acquire()
+        try:
+            state.outstanding -= 1
+        finally:
+            _replica_lock.release()
+
+    def _read(self, name, *args):
+        candidates = self._candidates()
+        for replica in candidates:
+            state = self._begin(replica)
+            try:
+                return getattr(replica, name)(*args)
+            except Error as e:
+                if not is_server_failure(e) or replica is candidates[-1]:
+                    raise
+                state.mark_down()
+            finally:
+                self._end(state)
+
+    def info(self):
+        return self._read('info')
+
+    def items(self, docId):
+        return self._read('items', docId)
+
+    def query(self, range, geom):
+        return self._read('query', range, geom)
+
+    def iter_query(self, range, geom):
+        candidates = self._candidates()
+        for replica in candidates:
+            state = self._begin(replica)
+            started = False
+            try:
+                for item in replica.iter_query(range, geom):
+                    started = True
+                    yield item
+                return
+            except Error as e:
+                # Items already yielded can't be taken back
+                if not is_server_failure(e) or started \
+                        or replica is candidates[-1]:
+                    raise
+                state.mark_down()
+            finally:
+                self._end(state)
+
+    def _write(self, name, *args):
+        # The primary has the change once it succeeds there, so a replica
+        # that misses it is marked down, and the write kept for replay,
+        # rather than failing the write. Writes to a replica that is down
+        # or still has writes to replay are kept behind them.
+        result = getattr(self.primary, name)(*args)
+        if self.fanout:
+            for replica in self.replicas:
+                state = get_replica_state(replica.uri)
+                _replica_lock.acquire()
+                try:
+                    behind = state.stale or state.down_until or state.missed
+                    if behind:
+                        state.miss(name, args)
+                finally:
+                    _replica_lock.release()
+                if behind:
+                    continue
+                try:
+                    getattr(replica, name)(*args)
+                except Error as e:
+                    log.warn("Failed to %s replica %s: %s",
+                             name, replica.uri, str(e))
+                    _replica_lock.acquire()
+                    try:
+                        state.miss(name, args)
+                        state.mark_down()
+                    finally:
+                        _replica_lock.release()
+        return result
+
+    def batch(self, doc):
+        return self._write('batch', doc)
+
+    def clear(self):
+        return self._write('clear')
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
     def delete_query(self):
         pass
 
@@ -410,18 +1340,30 @@ class VaytrouConnectionManager(object):
 
     def __init__(self, vaytrou_index, connection_factory=VaytrouConnection):
         self.vaytrou_uri = vaytrou_index.vaytrou_uri
+        self.vaytrou_read_uris = tuple(vaytrou_index.vaytrou_read_uris)
+        self.vaytrou_write_fanout = bool(vaytrou_index.vaytrou_write_fanout)
         self.response_page_size = vaytrou_index.response_page_size
+        self.max_response_page_size = vaytrou_index.max_response_page_size
+        self.pending_changes = []
         self._joined = False
         self._connection_factory = connection_factory
-        self._connection = connection_factory(
-            self.vaytrou_uri, self.response_page_size)
+        self._connection = self._make_connection()
+
+    def _make_connection(self):
+        if self.vaytrou_read_uris:
+            return ReplicatedVaytrouConnection(
+                self.vaytrou_uri, self.response_page_size,
+                self.vaytrou_read_uris, self.vaytrou_write_fanout,
+                self._connection_factory, self.max_response_page_size)
+        return self._connection_factory(
+            self.vaytrou_uri, self.response_page_size,
+            self.max_response_page_size)
 
     @property
     def connection(self):
         c = self._connection
         if c is None:
-            c = self._connection_factory(
-                self.vaytrou_uri, self.response_page_size)
+            c = self._make_connection()
             self._connection = c
         return c
 
@@ -437,6 +1379,7 @@ class VaytrouConnectionManager(object):
                 self._connection = None
                 c.close()
         finally:
+            self.pending_changes = []
             self._joined = False
 
     def tpc_begin(self, transaction):
@@ -456,11 +1399,17 @@ class VaytrouConnectionManager(object):
             except:
                 self.abort(transaction)
                 raise
+            # Peers learn of these changes from the published changelog;
+            # this process need not wait for its next query to evict them
+            if self.pending_changes:
+                get_query_cache(self.vaytrou_uri).evict(self.pending_changes)
         finally:
+            self.pending_changes = []
             self._joined = False
 
     def tpc_abort(self, transaction):
-        pass
+        self.pending_changes = []
+        self._joined = False
 
     def sortKey(self):
         return self.vaytrou_uri
@@ -17,10 +17,35 @@ class IFeature(Interface):
 class IVaytrouIndex(IPluggableIndex):
     """A ZCatalog multi-index that uses Vaytrou for storage and queries."""
     vaytrou_uri = Attribute("The URI of the Vaytrou server")
+    vaytrou_read_uris = Attribute("URIs of Vaytrou replicas for queries")
     connection_manager = Attribute("""
         An IHTTPConnectionManager that is specific to the ZODB connection.
         """)
 
+    def createChangelog():
+        """Create the changelog through which ZEO clients share changes."""
+
+    def updateSummaries():
+        """Rebuild the stored bounds and points from the Vaytrou server."""
+
+    def getBoundsForObject(documentId, default=None):
+        """Return the locally stored bounds of a document."""
+
+    def getPointForObject(documentId, default=None):
+        """Return the locally stored representative point of a document."""
+
+    def getSummariesForObjects(documentIds):
+        """Return a mapping of document ids to bbox and point summaries.
+
+        Reads only local storage and makes no request to Vaytrou.
+        """
+
+    def spatialJoin(targets, containerIds=None, cell_size=1.0):
+        """List the ids of polygon documents containing each target.
+
+        Targets may be document ids, points or geometries.
+        """
+
 
 class IVaytrouConnectionManager(Interface):
     """Provides a Vaytrou connection and transaction integration.
@@ -31,6 +56,8 @@ class IVaytrouConnectionManager(Interface):
     connection = Attribute("An instance of httplib2.Http")
     #schema = Attribute("An ISolrSchema instance")
     vaytrou_uri = Attribute("The URI of the Vaytrou server")
+    pending_changes = Attribute(
+        "Bounds of documents changed in the current transaction")
 
     def set_changed():
         """Adds the Solr connection to the current transaction.
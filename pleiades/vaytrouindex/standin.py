@@ -0,0 +1,159 @@
+"""A stand-in Vaytrou server for local testing
+
+Keeps features in memory and answers the requests VaytrouConnection makes:
+info, items, paged intersection/within queries, and batch index, unindex
+and clear. Several can be run on different ports to exercise replica
+failover and load balancing, for example:
+
+    vaytrou-standin --port 8891
+    vaytrou-standin --port 8892 --delay 0.5
+    vaytrou-standin --port 8893 --fail-status 503
+
+Failure can also be toggled on a running server by POSTing
+{"fail_status": 503} or {"fail_status": 0}.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from simplejson import dumps, loads
+from threading import Lock
+from urlparse import parse_qs, urlparse
+import time
+
+
+def _bounds(feature):
+    bbox = feature.get('bbox')
+    if bbox and len(bbox) >= 4:
+        n = len(bbox) // 2
+        return list(bbox[:2]) + list(bbox[n:n + 2])
+    xs, ys = [], []
+
+    def walk(coords):
+        if coords and isinstance(coords[0], (int, long, float)):
+            xs.append(coords[0])
+            ys.append(coords[1])
+        else:
+            for c in coords or ():
+                walk(c)
+    walk((feature.get('geometry') or {}).get('coordinates'))
+    if not xs:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, delay=0.0, fail_status=0):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.delay = delay
+        self.fail_status = fail_status
+        self.features = {}
+        self.requests = 0
+        self.lock = Lock()
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, body):
+        content = dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _begin(self):
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.requests += 1
+        finally:
+            server.lock.release()
+        if server.delay:
+            time.sleep(server.delay)
+        if server.fail_status:
+            self._reply(server.fail_status, {'error': 'stand-in failure'})
+            return False
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if not self._begin():
+            return
+        features = self.server.features
+        if path == '':
+            self._reply(200, {
+                'num_items': len(features),
+                'requests': self.server.requests})
+        elif path.startswith('items/'):
+            feature = features.get(path[len('items/'):])
+            self._reply(200, {'items': feature and [feature] or []})
+        elif path in ('intersection', 'within'):
+            q = map(float, params['bbox'].split(','))
+            if len(q) == 2:
+                q = q + q
+            hits = []
+            for fid in sorted(features):
+                b = _bounds(features[fid])
+                if b is None:
+                    continue
+                if path == 'within':
+                    match = q[0] <= b[0] and b[2] <= q[2] \
+                        and q[1] <= b[1] and b[3] <= q[3]
+                else:
+                    match = not (b[2] < q[0] or b[0] > q[2]
+                                 or b[3] < q[1] or b[1] > q[3])
+                if match:
+                    hits.append(features[fid])
+            start = int(params.get('start', 0))
+            count = int(params.get('count', 0)) or 20
+            page = hits[start:start + count]
+            self._reply(200, {
+                'hits': len(hits), 'count': len(page), 'items': page})
+        else:
+            self._reply(404, {'error': 'not supported by the stand-in'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        doc = loads(self.rfile.read(length))
+        if 'fail_status' in doc:
+            self.server.fail_status = int(doc['fail_status'])
+            self._reply(200, {'fail_status': self.server.fail_status})
+            return
+        if not self._begin():
+            return
+        features = self.server.features
+        if doc.get('clear'):
+            features.clear()
+        for feature in doc.get('unindex', ()):
+            features.pop(str(feature['id']), None)
+        for feature in doc.get('index', ()):
+            features[str(feature['id'])] = feature
+        self._reply(200, {'num_items': len(features)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=8889)
+    parser.add_option('--delay', type='float', default=0.0,
+                      help="Seconds to wait before each response")
+    parser.add_option('--fail-status', type='int', default=0,
+                      help="Answer every request with this status")
+    options, args = parser.parse_args()
+    server = StandinServer(
+        (options.host, options.port), options.delay, options.fail_status)
+    print("Vaytrou stand-in on http://%s:%d" % (options.host, options.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import unittest
+
+from BTrees.OOBTree import OOBTree
+
+from pleiades.vaytrouindex.cache import FLUSH, QueryCache
+
+
+class QueryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.changelog = OOBTree()
+        self.latest = 0
+        self.cache = QueryCache()
+        self.cache.sync(self.changelog, self.latest)
+        self.cache.set('west', (-10.0, -10.0, -1.0, 10.0), [{'id': 1}])
+        self.cache.set('east', (1.0, -10.0, 10.0, 10.0), [{'id': 2}])
+
+    def publish(self, changes, generation=None, token='a'):
+        if generation is None:
+            generation = self.latest + 1
+        self.changelog[(generation, token)] = changes
+        self.latest += 1
+
+    def test_replay_evicts_intersecting(self):
+        self.publish([(5.0, 0.0, 5.0, 0.0)])
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('west'), ({'id': 1},))
+        self.assertEqual(self.cache.get('east'), None)
+
+    def test_entries_replayed_once(self):
+        self.publish([(5.0, 0.0, 5.0, 0.0)])
+        self.cache.sync(self.changelog, self.latest)
+        self.cache.set('east', (1.0, -10.0, 10.0, 10.0), [{'id': 2}])
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('east'), ({'id': 2},))
+
+    def test_shared_generation(self):
+        # Concurrent writers that read the same generation
+        self.publish([(5.0, 0.0, 5.0, 0.0)], 1, 'a')
+        self.cache.sync(self.changelog, self.latest)
+        self.publish([(-5.0, 0.0, -5.0, 0.0)], 1, 'b')
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('west'), None)
+
+    def test_late_entry_below_window_flushes(self):
+        for i in range(QueryCache.slack + 10):
+            self.publish([(50.0, 50.0, 50.0, 50.0)])
+        self.cache.sync(self.changelog, self.latest)
+        self.cache.set('west', (-10.0, -10.0, -1.0, 10.0), [{'id': 1}])
+        # A long transaction that read generation 1 commits now
+        self.publish([(99.0, 99.0, 99.0, 99.0)], 2, 'late')
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('west'), None)
+
+    def test_pruned_entries_flush(self):
+        self.publish([(50.0, 50.0, 50.0, 50.0)])
+        self.publish([(50.0, 50.0, 50.0, 50.0)])
+        del self.changelog[(1, 'a')]
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('west'), None)
+        self.assertEqual(self.cache.get('east'), None)
+
+    def test_flush_entry(self):
+        self.publish([FLUSH])
+        self.cache.sync(self.changelog, self.latest)
+        self.assertEqual(self.cache.get('west'), None)
+
+    def test_older_view_ignored(self):
+        self.publish([(5.0, 0.0, 5.0, 0.0)])
+        self.cache.sync(self.changelog, self.latest)
+        self.cache.set('east', (1.0, -10.0, 10.0, 10.0), [{'id': 2}])
+        self.cache.sync(self.changelog, self.latest - 1)
+        self.assertEqual(self.cache.get('east'), ({'id': 2},))
+
+    def test_set_after_evict_skipped(self):
+        evictions = self.cache.evictions
+        self.cache.evict([(5.0, 0.0, 5.0, 0.0)])
+        self.cache.set('east', (1.0, -10.0, 10.0, 10.0), [{'id': 3}],
+                       evictions)
+        self.assertEqual(self.cache.get('east'), None)
+
+    def test_bounded_by_items(self):
+        cache = QueryCache(max_items=3, max_result_items=2)
+        cache.set('a', None, [1, 2])
+        cache.set('b', None, [3])
+        cache.set('c', None, [4])
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), (4,))
+        cache.set('d', None, [5, 6, 7])
+        self.assertEqual(cache.get('d'), None)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,24 @@
+from pleiades.vaytrouindex.interfaces import IVaytrouIndex
+from Products.CMFCore.utils import getToolByName
+
+
+def vaytrou_indexes(context):
+    catalog = getToolByName(context, 'portal_catalog')
+    for name in catalog._catalog.indexes.keys():
+        index = catalog._catalog.getIndex(name)
+        if IVaytrouIndex.providedBy(index):
+            yield index
+
+
+def update_summaries(context):
+    """Store bounds and points of documents indexed before 0.2
+    """
+    for index in vaytrou_indexes(context):
+        index.updateSummaries()
+
+
+def create_changelogs(context):
+    """Create the changelogs that share changes between ZEO clients
+    """
+    for index in vaytrou_indexes(context):
+        index.createChangelog()
@@ -30,6 +30,9 @@ setup(name='pleiades.vaytrouindex',
       entry_points="""
       # -*- Entry points: -*-
 
+      [console_scripts]
+      vaytrou-standin = pleiades.vaytrouindex.standin:main
+
       [distutils.setup_keywords]
       paster_plugins = setuptools.dist:assert_string_list
 